@@ -15,36 +15,122 @@
 # limitations under the License.
 
 import argparse
+import collections
 import configparser
-import daemon
+import fcntl
+import functools
 import irc.bot
 import logging.config
 import os
-import time
 import ssl
+import time
 
 import ptgbot.db
 
-try:
-    import daemon.pidlockfile as pid_file_module
-except ImportError:
-    # as of python-daemon 1.6 it doesn't bundle pidlockfile anymore
-    # instead it depends on lockfile-0.9.1
-    import daemon.pidfile as pid_file_module
-
-# https://bitbucket.org/jaraco/irc/issue/34/
-# irc-client-should-not-crash-on-failed
-# ^ This is why pep8 is a bad idea.
-irc.client.ServerConnection.buffer_class.errors = 'replace'
 ANTI_FLOOD_SLEEP = 2
 
 
+class ReusableLineBuffer(irc.client.ServerConnection.buffer_class):
+    """Line buffer accumulating into a single bytearray.
+
+    Undecodable bytes are replaced rather than raising, see
+    https://bitbucket.org/jaraco/irc/issue/34/
+    """
+
+    errors = 'replace'
+
+    def __init__(self):
+        super().__init__()
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer.extend(data)
+
+    def lines(self):
+        buf = self.buffer
+        lines = []
+        start = 0
+        with memoryview(buf) as view:
+            while True:
+                end = buf.find(b'\n', start)
+                if end < 0:
+                    break
+                stop = end
+                if stop > start and buf[stop - 1] == 0x0d:
+                    stop -= 1
+                lines.append(str(view[start:stop], self.encoding,
+                                 self.errors))
+                start = end + 1
+        del buf[:start]
+        return iter(lines)
+
+
+irc.client.ServerConnection.buffer_class = ReusableLineBuffer
+
+
+class ReplyBuffer():
+    """Collect the replies to one incoming message and send them as a
+    single line, so they only pay the anti-flood delay once.
+    """
+
+    def __init__(self, bot, channel):
+        self.bot = bot
+        self.channel = channel
+        self.lines = []
+
+    def add(self, line):
+        self.lines.append(line)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.lines:
+            self.bot.send(self.channel, ' - '.join(self.lines))
+
+
+class PidFile():
+    """Hold an exclusive lock on a pid file for the life of the daemon.
+
+    The lock is released by the kernel when the process exits, so a pid
+    file left behind by a crash does not prevent the next start.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = None
+
+    def __enter__(self):
+        self.fp = open(self.path, 'a+')
+        try:
+            fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.fp.close()
+            raise Exception("Unable to lock pid file at %s" % self.path)
+        self.fp.seek(0)
+        self.fp.truncate()
+        self.fp.write("%d\n" % os.getpid())
+        self.fp.flush()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.fp.close()
+
+
 class PTGBot(irc.bot.SingleServerIRCBot):
     log = logging.getLogger("ptgbot.bot")
 
+    # Map command words to the PTGDataBase methods implementing them
+    _ROOM_VERBS = {'now': 'add_now', 'next': 'add_next'}
+    _ADMIN_CMDS = {'wipe': 'wipe'}
+
     def __init__(self, nickname, password, server, port, channels, db):
         if port == 6697:
-            factory = irc.connection.Factory(wrapper=ssl.wrap_socket)
+            # The factory, and so this context, is reused on reconnects
+            context = ssl.create_default_context()
+            wrapper = functools.partial(context.wrap_socket,
+                                        server_hostname=server)
+            factory = irc.connection.Factory(wrapper=wrapper)
             irc.bot.SingleServerIRCBot.__init__(self,
                                                 [(server, port)],
                                                 nickname, nickname,
@@ -58,6 +144,9 @@ class PTGBot(irc.bot.SingleServerIRCBot):
         self.channel_list = channels
         self.identify_msg_cap = False
         self.data = db
+        self._send_queue = collections.deque()
+        self._next_send = 0.0
+        self._pump_scheduled = False
 
     def on_nicknameinuse(self, c, e):
         self.log.debug("Nickname in use, releasing")
@@ -65,11 +154,10 @@ class PTGBot(irc.bot.SingleServerIRCBot):
         c.privmsg("nickserv", "identify %s " % self.password)
         c.privmsg("nickserv", "ghost %s %s" % (self.nickname, self.password))
         c.privmsg("nickserv", "release %s %s" % (self.nickname, self.password))
-        time.sleep(ANTI_FLOOD_SLEEP)
-        c.nick(self.nickname)
+        self._next_send = time.monotonic() + ANTI_FLOOD_SLEEP
+        self._enqueue(c.nick, self.nickname)
 
     def on_welcome(self, c, e):
-        self.identify_msg_cap = False
         self.log.debug("Requesting identify-msg capability")
         c.cap('REQ', 'identify-msg')
         c.cap('END')
@@ -77,96 +165,119 @@ class PTGBot(irc.bot.SingleServerIRCBot):
             self.log.debug("Identifying to nickserv")
             c.privmsg("nickserv", "identify %s " % self.password)
         for channel in self.channel_list:
-            self.log.info("Joining %s" % channel)
-            c.join(channel)
-            time.sleep(ANTI_FLOOD_SLEEP)
+            self.log.info("Joining %s", channel)
+            self._enqueue(c.join, channel)
+
+    def on_disconnect(self, c, e):
+        # Anything still queued was meant for the lost connection, and the
+        # capability will need to be acked again after reconnecting
+        self._send_queue.clear()
+        self.identify_msg_cap = False
 
     def on_cap(self, c, e):
-        self.log.debug("Received cap response %s" % repr(e.arguments))
+        self.log.debug("Received cap response %r", e.arguments)
         if e.arguments[0] == 'ACK' and 'identify-msg' in e.arguments[1]:
             self.log.debug("identify-msg cap acked")
             self.identify_msg_cap = True
 
-    def usage(self, channel):
-        self.send(channel, "Format is '@ROOM [now|next] SESSION'")
+    def usage(self, buf):
+        buf.add("Format is '@ROOM [now|next] SESSION'")
 
     def on_pubmsg(self, c, e):
         if not self.identify_msg_cap:
             self.log.debug("Ignoring message because identify-msg "
                            "cap not enabled")
             return
-        nick = e.source.split('!')[0]
-        auth = e.arguments[0][0] == '+'
+        idx = e.source.find('!')
+        nick = e.source if idx < 0 else e.source[:idx]
         msg = e.arguments[0][1:]
         chan = e.target
 
-        if msg.startswith('#'):
-            if not (self.channels[chan].is_voiced(nick) or
-                    self.channels[chan].is_oper(nick)):
-                self.send(chan, "%s: Need voice to issue commands" % (nick,))
-                return
-            words = msg.split()
-            if len(words) < 3:
-                self.send(chan, "%s: Incorrect number of arguments" % (nick,))
-                self.usage(chan)
-                return
-            room = words[0][1:].lower()
-            # TODO: Add test for room/day/person match
-            adverb = words[1].lower()
-            session = str.join(' ', words[2:])
-            if adverb == 'now':
-                self.data.add_now(room, session)
-            elif adverb == 'next':
-                self.data.add_next(room, session)
-            else:
-                self.send(chan, "%s: unknown directive '%s'" % (nick, adverb))
-                self.usage(chan)
-                return
-            self.send(chan, "%s: ack" % (nick,))
+        with ReplyBuffer(self, chan) as buf:
+            if msg.startswith('#'):
+                if not (self.channels[chan].is_voiced(nick) or
+                        self.channels[chan].is_oper(nick)):
+                    buf.add("%s: Need voice to issue commands" % (nick,))
+                    return
+                words = msg.split(None, 2)
+                if len(words) < 3:
+                    buf.add("%s: Incorrect number of arguments" % (nick,))
+                    self.usage(buf)
+                    return
+                room = words[0][1:].lower()
+                # TODO: Add test for room/day/person match
+                adverb = words[1].lower()
+                session = words[2].rstrip()
+                method_name = self._ROOM_VERBS.get(adverb)
+                if method_name is None:
+                    buf.add("%s: unknown directive '%s'" % (nick, adverb))
+                    self.usage(buf)
+                    return
+                getattr(self.data, method_name)(room, session)
+                buf.add("%s: ack" % (nick,))
 
-        if msg.startswith('!'):
-            if not self.channels[chan].is_oper(nick):
-                self.send(chan, "%s: Need op for admin commands" % (nick,))
-                return
-            words = msg.split()
-            command = words[0][1:].lower()
-            if command == 'wipe':
-                self.data.wipe()
-            else:
-                self.send(chan, "%s: unknown command '%s'" % (nick, command))
-                return
-            self.send(chan, "%s: done" % (nick,))
+            elif msg.startswith('!'):
+                if not self.channels[chan].is_oper(nick):
+                    buf.add("%s: Need op for admin commands" % (nick,))
+                    return
+                words = msg.split(None, 1)
+                command = words[0][1:].lower()
+                method_name = self._ADMIN_CMDS.get(command)
+                if method_name is None:
+                    buf.add("%s: unknown command '%s'" % (nick, command))
+                    return
+                getattr(self.data, method_name)()
+                buf.add("%s: done" % (nick,))
 
     def send(self, channel, msg):
-        self.connection.privmsg(channel, msg)
-        time.sleep(ANTI_FLOOD_SLEEP)
+        self._enqueue(self.connection.privmsg, channel, msg)
+
+    def _enqueue(self, func, *args):
+        self._send_queue.append((func, args))
+        if not self._pump_scheduled:
+            self._pump()
+
+    def _pump(self):
+        # Send queued commands no faster than one every ANTI_FLOOD_SLEEP
+        # seconds, letting the reactor call us back when the next one is due
+        # instead of blocking it.
+        self._pump_scheduled = False
+        while self._send_queue:
+            delay = self._next_send - time.monotonic()
+            if delay > 0:
+                self.reactor.scheduler.execute_after(delay, self._pump)
+                self._pump_scheduled = True
+                return
+            func, args = self._send_queue.popleft()
+            func(*args)
+            self._next_send = time.monotonic() + ANTI_FLOOD_SLEEP
 
 
 def start(configpath):
     config = configparser.RawConfigParser()
     config.read(configpath)
+    cfg = dict(config.items('ircbot'))
+    dbcfg = dict(config.items('db'))
 
-    if config.has_option('ircbot', 'log_config'):
-        log_config = config.get('ircbot', 'log_config')
-        fp = os.path.expanduser(log_config)
+    if 'log_config' in cfg:
+        fp = os.path.expanduser(cfg['log_config'])
         if not os.path.exists(fp):
             raise Exception("Unable to read logging config file at %s" % fp)
         logging.config.fileConfig(fp)
     else:
         logging.basicConfig(level=logging.DEBUG)
 
-    channels = ['#' + name.strip() for name in
-                config.get('ircbot', 'channels').split(',')]
+    channels = ['#' + name.strip() for name in cfg['channels'].split(',')]
 
     db = ptgbot.db.PTGDataBase(
-        config.get('db', 'filename'),
-        config.get('db', 'ethercalc'),
-        config.get('db', 'cells'))
-
-    bot = PTGBot(config.get('ircbot', 'nick'),
-                 config.get('ircbot', 'pass'),
-                 config.get('ircbot', 'server'),
-                 config.getint('ircbot', 'port'),
+        dbcfg['filename'],
+        dbcfg['ethercalc'],
+        dbcfg['cells'])
+
+    bot = PTGBot(cfg['nick'],
+                 cfg['pass'],
+                 cfg['server'],
+                 int(cfg['port']),
                  channels,
                  db)
     bot.start()
@@ -181,11 +292,13 @@ def main():
     args = parser.parse_args()
 
     if not args.nodaemon:
-        pid = pid_file_module.TimeoutPIDLockFile(
-            "/var/run/ptgbot/ptgbot.pid", 10)
+        import daemon
+
+        pid = PidFile("/var/run/ptgbot/ptgbot.pid")
         with daemon.DaemonContext(pidfile=pid):
-            start(args.configfile)
-    start(args.configfile)
+            start(args.configfile[0])
+    else:
+        start(args.configfile[0])
 
 
 if __name__ == "__main__":
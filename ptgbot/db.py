@@ -15,11 +15,16 @@
 # limitations under the License.
 
 import json
+import logging
 import os
 import requests
 
+# Seconds to wait for ethercalc, during which the bot handles no events
+ETHERCALC_TIMEOUT = 5
+
 
 class PTGDataBase():
+    log = logging.getLogger("ptgbot.db")
 
     def __init__(self, filename, ethercalc_url, ethercalc_cells):
         self.filename = filename
@@ -45,7 +50,12 @@ class PTGDataBase():
 
     def from_ethercalc(self):
         if self.ethercalc_url:
-            ethercalc = requests.get(self.ethercalc_url).json()
+            try:
+                ethercalc = requests.get(self.ethercalc_url,
+                                         timeout=ETHERCALC_TIMEOUT).json()
+            except (requests.RequestException, ValueError):
+                self.log.exception("Unable to fetch %s", self.ethercalc_url)
+                return
             self.data['ethercalc'] = []
             for cell in self.ethercalc_cells:
                 if ('comment' in ethercalc[cell] and